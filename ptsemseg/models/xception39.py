@@ -13,6 +13,7 @@ normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5],
                                   std=[0.5, 0.5, 0.5])
 The resize parameter of the validation transform should be 333, and make sure to center crop at 299x299
 """
+import copy
 import math
 import torch
 import torch.nn as nn
@@ -39,6 +40,28 @@ pretrained_settings = {
 }
 
 
+def fuse_conv_bn(conv, bn):
+	"""
+	Fold a frozen BatchNorm2d into the convolution feeding it, in place:
+	W_hat = W * gamma / sqrt(var + eps), b_hat = (b - mean) * gamma / sqrt(var + eps) + beta
+	"""
+	with torch.no_grad():
+		scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+		bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+		conv.weight = nn.Parameter(conv.weight * scale.reshape(-1, 1, 1, 1))
+		conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+	return conv
+
+
+class Add(nn.Module):
+	"""
+	x + y behind the FloatFunctional.add interface, quantize_xception39() swaps in a quantized add
+	"""
+
+	def add(self, x, y):
+		return x + y
+
+
 class SeparableConv2d(nn.Module):
 	def __init__(self, in_channels, out_channels, kernel_size=1, stride=1, padding=0, dilation=1, bias=False):
 		super(SeparableConv2d, self).__init__()
@@ -51,6 +74,14 @@ class SeparableConv2d(nn.Module):
 		x = self.pointwise(x)
 		return x
 
+	def fuse_pointwise_bn(self, bn):
+		"""
+		Fold the BatchNorm2d that follows this layer into the 1x1 pointwise conv, in place.
+		The depthwise conv1 sits before the pointwise conv, so it is left alone.
+		"""
+		fuse_conv_bn(self.pointwise, bn)
+		return self
+
 
 class Block(nn.Module):
 	def __init__(self, in_filters, out_filters, reps, strides=1, start_with_relu=True, grow_first=True):
@@ -62,46 +93,47 @@ class Block(nn.Module):
 		else:
 			self.skip = None
 
-		self.relu = nn.ReLU(inplace=True)
+		# one non-inplace ReLU per position: an inplace one at rep[0] would overwrite inp, which is also the identity skip
 		rep = []
 
 		filters = in_filters
 		if grow_first:
-			rep.append(self.relu)
+			rep.append(nn.ReLU(inplace=False))
 			rep.append(SeparableConv2d(in_filters, out_filters, 3, stride=1, padding=1, bias=False))
 			rep.append(nn.BatchNorm2d(out_filters))
 			filters = out_filters
 
 		for i in range(reps - 1):
-			rep.append(self.relu)
+			rep.append(nn.ReLU(inplace=False))
 			rep.append(SeparableConv2d(filters, filters, 3, stride=1, padding=1, bias=False))
 			rep.append(nn.BatchNorm2d(filters))
 
 		if not grow_first:
-			rep.append(self.relu)
+			rep.append(nn.ReLU(inplace=False))
 			rep.append(SeparableConv2d(in_filters, out_filters, 3, stride=1, padding=1, bias=False))
 			rep.append(nn.BatchNorm2d(out_filters))
 
 		if not start_with_relu:
 			rep = rep[1:]
-		else:
-			rep[0] = nn.ReLU(inplace=False)
 
 		if strides != 1:
 			rep.append(nn.MaxPool2d(3, strides, 1))
-		self.rep = nn.Sequential(*rep)
+		# a ModuleList iterated in forward() is unrolled by TorchScript; same state_dict keys as the former Sequential
+		self.rep = nn.ModuleList(rep)
+		self.skip_add = Add()
 
 	def forward(self, inp):
-		x = self.rep(inp)
-
 		if self.skip is not None:
-			skip = self.skip(inp)
-			skip = self.skipbn(skip)
+			skip = self.skipbn(self.skip(inp))
 		else:
 			skip = inp
 
-		x += skip
-		return x
+		# no activation after the add: the next block's rep starts with its own ReLU,
+		# while its identity skip and the pooled block6 output need the pre-activation sum
+		x = inp
+		for m in self.rep:
+			x = m(x)
+		return self.skip_add.add(x, skip)
 
 
 class SpatialPathModule(nn.Module):
@@ -222,57 +254,40 @@ class Bisenet(nn.Module):
 	# #-----------------------------
 
 	def forward(self, input):
-		print('the size of input image is ', input.size())
-
 		# Context Path
 		y = self.conv1_xception39(input)
 		# print('the size of xception39 after conv1', y.size())
 		y = self.maxpool_xception39(y)
-		print(' level 1: 1 / 4 the size of xception39 after maxpool', y.size())
 
 		y = self.block1_xception39(y)
 		# print('the size of xception39 after block1', y.size())
 		y = self.block2_xception39(y)
-		print(' level 2: 1 / 8 the size of xception39 after block2', y.size())
 
 		y = self.block3_xception39(y)
 		# print(' level 3: 1 / 16 the size of xception39 after block3', y.size())
 		y = self.block4_xception39(y)
-		print(' level 3: 1 / 16 the size of xception39 after block4', y.size())
 		y = F.adaptive_avg_pool2d(y, (28, 28))
 		y_arm = self.arm1_context_path(y)
-		print(' the size of image feature after first y_arm', y_arm.size())
 
 		y = self.block5_xception39(y)
 		# print('the size of xception39 after block5', y.size())
 		y_32 = self.block6_xception39(y)
-		print(' level 4: 1 / 32 the size of xception39 after block6', y.size())
-		y = F.adaptive_avg_pool2d(y_32, (28, 28))
-		y_arm2 = self.arm2_context_path(y)
-		print(' the size of image feature after second y_arm', y_arm2.size())
 		y_32_up = F.adaptive_avg_pool2d(y_32, (28, 28))
-		print(' the size of y_32_up is ', y_32_up.size())
+		y_arm2 = self.arm2_context_path(y_32_up)
 
 		# Concatenate the image feature of ARM1, ARM2 and y_32_up
 		y_cat = torch.cat([y_arm, y_arm2], dim=1)
 		y_cat = torch.cat([y_cat, y_32_up], dim=1)
-		print(' size of y_cat is ', y_cat.size())
 		# Spatial Path
 		sp = self.block1_spatial_path(input)
-		print(' level 1 of spatial path, the size of sp is ', sp.size())
 		sp = self.block2_spatial_path(sp)
-		print(' level 2 of spatial path, the size of sp is ', sp.size())
 		sp = self.block3_spatial_path(sp)
-		print(' level 3 of spatial path, the size of sp is ', sp.size())
 
 		# Concatenate the image feature after context path : y_cat and the image feature after spatial path : sp
 		y_cat = torch.cat([y_cat, sp], dim=1)
-		print(' the size of image feature after the context path and spatial path is ', y_cat.size())
 		y_cat = self.FFM(y_cat)
-		print(' the size of image feature after FFM', y_cat.size())
 
 		y_cat = F.adaptive_avg_pool2d(y_cat, (256, 256))
-		print(' the size of image feature after FFM', y_cat.size())
 		# y = F.adaptive_avg_pool2d(y, (1, 1))
 		# y = y.view(y.size(0), -1)
 		# # print('the size of xception39 is ', y.size()[1])
@@ -330,8 +345,12 @@ class Xception(nn.Module):
 		self.block5_xception39 = Block(in_filters=32, out_filters=64, reps=1, strides=2, start_with_relu=True, grow_first=True)
 		self.block6_xception39 = Block(in_filters=64, out_filters=64, reps=3, strides=1, start_with_relu=True, grow_first=True)
 
+		self.gap = nn.AdaptiveAvgPool2d(1)
 		self.fc_xception39 = nn.Linear(in_features=64, out_features=self.num_classes)
 
+		# NHWC lets cuDNN / oneDNN pick their fast depthwise kernels for SeparableConv2d.conv1
+		self.to(memory_format=torch.channels_last)
+
 	# #------- init weights --------
 	# for m in self.modules():
 	#     if isinstance(m, nn.Conv2d):
@@ -342,47 +361,134 @@ class Xception(nn.Module):
 	#         m.bias.data.zero_()
 	# #-----------------------------
 
+	def fuse(self):
+		"""
+		Fold every BatchNorm2d into the preceding convolution and replace it by an identity.
+		Only valid at inference, call eval() first.
+		"""
+		assert not self.training, "fuse() folds the running statistics, call eval() first"
+		for m in list(self.modules()):
+			if isinstance(m, Block) and isinstance(getattr(m, "skipbn", None), nn.BatchNorm2d):
+				fuse_conv_bn(m.skip, m.skipbn)
+				m.skipbn = nn.Identity()
+			if isinstance(m, (nn.Sequential, nn.ModuleList)):
+				for i in range(1, len(m)):
+					conv, bn = m[i - 1], m[i]
+					if not isinstance(bn, nn.BatchNorm2d):
+						continue
+					if isinstance(conv, SeparableConv2d):
+						conv.fuse_pointwise_bn(bn)
+					elif isinstance(conv, nn.Conv2d):
+						fuse_conv_bn(conv, bn)
+					else:
+						continue
+					m[i] = nn.Identity()
+		return self
+
 	def forward(self, input):
+		input = input.contiguous(memory_format=torch.channels_last)
 		y = self.conv1_xception39(input)
-		print('the size of xception39 after conv1', y.size())
 		y = self.maxpool_xception39(y)
-		print('the size of xception39 after maxpool', y.size())
 
 		y = self.block1_xception39(y)
-		print('the size of xception39 after block1', y.size())
 		y = self.block2_xception39(y)
-		print('the size of xception39 after block2', y.size())
 		y = self.block3_xception39(y)
-		print('the size of xception39 after block3', y.size())
 		y = self.block4_xception39(y)
-		print('the size of xception39 after block4', y.size())
 		y = self.block5_xception39(y)
-		print('the size of xception39 after block5', y.size())
 		y = self.block6_xception39(y)
-		print('the size of xception39 after block6', y.size())
-		y = F.adaptive_avg_pool2d(y, (1, 1))
-		y = y.view(y.size(0), -1)
-		print('the size of xception39 is ', y.size()[1])
+		y = torch.flatten(self.gap(y), 1)
 		y = self.fc_xception39(y)
 		return y
 
 
-def xception39(num_classes=1000, pretrained='imagenet'):
+def quantize_xception39(model, calibration_batches, backend='fbgemm'):
+	"""
+	Post-training static int8 quantization of an eval-mode, not yet fuse()d Xception.
+	inputs:
+		model: float Xception with trained weights, left untouched
+		calibration_batches: iterable of input tensors used to observe the activation ranges
+		backend: 'fbgemm' for x86 servers, 'qnnpack' for ARM / mobile
+	outputs:
+		qmodel: the converted int8 copy of model, wrapped with its quant / dequant stubs
+	The quantization modules are only created here, so the float models do not depend on torch.quantization.
+	torch.backends.quantized.engine is set to backend while calibrating and restored afterwards, the caller
+	must set it to backend again before running qmodel.
+	"""
+	assert not model.training, "quantize_xception39() expects an eval() model"
+	qmodel = copy.deepcopy(model)
+
+	# Conv+BN(+ReLU) groups, the pointwise conv of each SeparableConv2d with the BN (and ReLU) after it
+	modules_to_fuse = []
+	for name, m in qmodel.named_modules():
+		if not isinstance(m, Block):
+			continue
+		if isinstance(getattr(m, 'skipbn', None), nn.BatchNorm2d):
+			modules_to_fuse.append([name + '.skip', name + '.skipbn'])
+		for i in range(len(m.rep) - 1):
+			if isinstance(m.rep[i], SeparableConv2d) and isinstance(m.rep[i + 1], nn.BatchNorm2d):
+				group = ['{}.rep.{}.pointwise'.format(name, i), '{}.rep.{}'.format(name, i + 1)]
+				if i + 2 < len(m.rep) and isinstance(m.rep[i + 2], nn.ReLU):
+					group.append('{}.rep.{}'.format(name, i + 2))
+				modules_to_fuse.append(group)
+	torch.quantization.fuse_modules(qmodel, modules_to_fuse, inplace=True)
+	# residual adds of quantized tensors need the quantized add
+	for m in list(qmodel.modules()):
+		if isinstance(m, Block):
+			m.skip_add = nn.quantized.FloatFunctional()
+	qmodel = torch.quantization.QuantWrapper(qmodel).eval()
+
+	# fbgemm's default qconfig observes the weights per output channel, which keeps the depthwise convs accurate
+	previous_engine = torch.backends.quantized.engine
+	torch.backends.quantized.engine = backend
+	try:
+		qmodel.qconfig = torch.quantization.get_default_qconfig(backend)
+		torch.quantization.prepare(qmodel, inplace=True)
+		with torch.no_grad():
+			for batch in calibration_batches:
+				qmodel(batch)
+		torch.quantization.convert(qmodel, inplace=True)
+	finally:
+		torch.backends.quantized.engine = previous_engine
+	return qmodel
+
+
+def xception39(num_classes=1000, pretrained='imagenet', half=False, use_compile=False, device=None, script=False):
 	import torch
+	assert not (script and use_compile), "script and use_compile are alternative inference paths, pick one"
 	model = Xception(num_classes=num_classes)
 	if pretrained:
 		settings = pretrained_settings['xception'][pretrained]
 		assert num_classes == settings['num_classes'], \
 			"num_classes should be {}, but is {}".format(settings['num_classes'], num_classes)
-		model = Xception(num_classes=num_classes)
-		model.load_state_dict(torch.load('/home/donghao/.torch/models/xception-squeezzed.pth'))
+		model.load_state_dict(torch.load('/home/donghao/.torch/models/xception-squeezzed.pth', map_location='cpu'))
+	if device is not None:
+		model.to(device)
+
+	if script:
+		# inference only: the BNs are folded for good and the weights frozen into the graph,
+		# so pick half / device here, the returned module can no longer be moved or trained
+		model.eval()
+		model.fuse()
+		if half:
+			model.half()
+		model = torch.jit.optimize_for_inference(torch.jit.script(model))
+	elif half:
+		# fp16 weights for CUDA inference, feed half inputs
+		model.half()
+
+	if pretrained:
 		model.input_space = settings['input_space']
 		model.input_size = settings['input_size']
 		model.input_range = settings['input_range']
 		model.mean = settings['mean']
 		model.std = settings['std']
 
+	if use_compile:
+		# the convolutions stay separate aten / cuDNN calls; Inductor fuses the elementwise ops
+		# around them (BN, ReLU, residual add) and 'reduce-overhead' replays the graph with CUDA graphs
+		model = torch.compile(model, mode='reduce-overhead')
+
 	# # TODO: ugly
 	# model.last_linear = model.fc
 	# del model.fc
-	return model
\ No newline at end of file
+	return model
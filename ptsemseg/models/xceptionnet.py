@@ -16,7 +16,6 @@ The resize parameter of the validation transform should be 333, and make sure to
 import math
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 from torch.nn import init
 
@@ -150,6 +149,7 @@ class Xception(nn.Module):
 		self.conv4 = SeparableConv2d(1536, 2048, 3, 1, 1)
 		self.bn4 = nn.BatchNorm2d(2048)
 
+		self.gap = nn.AdaptiveAvgPool2d(1)
 		self.fc = nn.Linear(2048, num_classes)
 
 	# #------- init weights --------
@@ -166,17 +166,14 @@ class Xception(nn.Module):
 		x = self.conv1(input)
 		x = self.bn1(x)
 		x = self.relu(x)
-		print('x after conv1: ', x.size())
 
 		x = self.conv2(x)
 		x = self.bn2(x)
 		x = self.relu(x)
-		print('x after conv2: ', x.size())
 
 		x = self.block1(x)
 		x = self.block2(x)
 		x = self.block3(x)
-		print('x after block 3: ', x.size())
 
 		x = self.block4(x)
 		x = self.block5(x)
@@ -187,7 +184,6 @@ class Xception(nn.Module):
 		x = self.block9(x)
 		x = self.block10(x)
 		x = self.block11(x)
-		print('x after block 11: ', x.size())
 		x = self.block12(x)
 
 		x = self.conv3(x)
@@ -196,26 +192,18 @@ class Xception(nn.Module):
 
 		x = self.conv4(x)
 		x = self.bn4(x)
-		print('x after conv4: ', x.size())
 
 		return x
 
 	def logits(self, features):
 		x = self.relu(features)
-		print('in logits function，the size of xception after relu', x.size())
-		x = F.adaptive_avg_pool2d(x, (1, 1))
-		print('in logits function，the size of xception after adaptive_avg_pool2d', x.size())
-		x = x.view(x.size(0), -1)
-		print('in logits function，the size of xception after view', x.size())
+		x = torch.flatten(self.gap(x), 1)
 		x = self.last_linear(x)
-		print('in logits function，the size of xception after last_linear', x.size())
 		return x
 
 	def forward(self, input):
 		x = self.features(input)
-		print('the size of xception after features is ', x.size())
 		x = self.logits(x)
-		print('the size of xception after logits is ', x.size())
 		return x
 
 
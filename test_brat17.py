@@ -1,5 +1,6 @@
 import os
 import collections
+import tempfile
 import torch
 import torchvision
 import numpy as np
@@ -10,10 +11,14 @@ import nibabel
 import SimpleITK as sitk
 from random import randint
 import argparse
-from torch.autograd import Variable
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
 
+# os.umask can only be read by setting it, so do it once here rather than from the loader threads
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 def log(s):
 	if DEBUG:
@@ -73,19 +78,63 @@ def load_mha_volume_as_array(filename):
 	return nda
 
 
-def load_nifty_volume_as_array(filename, with_header=False):
+def save_volume_cache(data, cache_path):
+	"""
+	save data as cache_path atomically: it is written to a uniquely named temporary file in the same
+	folder and renamed into place, so concurrent runs never see a partly written cache.
+	A read-only folder or a failed write just leaves no cache behind.
+	"""
+	try:
+		fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(cache_path)))
+	except OSError:
+		return
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			np.save(f, data)
+		# mkstemp creates the file as 0600, give the cache the permissions a plain open() would
+		os.chmod(tmp_path, 0o666 & ~_UMASK)
+		os.replace(tmp_path, cache_path)
+	except OSError:
+		os.unlink(tmp_path)
+
+
+def load_nifty_volume_as_array(filename, with_header=False, out=None):
 	"""
 	load nifty image into numpy array, and transpose it based on the [z,y,x] axis order
 	The output array shape is like [Depth, Height, Width]
 	inputs:
 		filename: the input file name, should be *.nii or *.nii.gz
 		with_header: return affine and hearder infomation
+		out: optional preallocated [Depth, Height, Width] array (e.g. one channel of a stacked
+			volume), the transposed data is written straight into it
 	outputs:
-		data: a numpy data array
+		data: a float32 numpy data array, out if it was given, else possibly a read-only memory map
+	The decoded and transposed volume is cached next to the file as filename.t210.npy and reused
+	while it is newer than filename.
 	"""
 	img = nibabel.load(filename)
-	data = img.get_data()
-	data = np.transpose(data, [2, 1, 0])
+	cache_path = filename + '.t210.npy'
+	data = None
+	if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(filename):
+		# mapping the cache skips the gzip decode entirely
+		try:
+			data = np.load(cache_path, mmap_mode='r')
+			if out is not None:
+				np.copyto(out, data)
+				data = out
+		except (OSError, ValueError):
+			# unreadable, truncated or mis-shaped cache, decode the volume again and rewrite it
+			data = None
+	if data is None:
+		# decode straight to float32, without nibabel keeping a cached copy of the volume
+		data = img.get_fdata(dtype=np.float32, caching='unchanged')
+		if out is not None:
+			np.copyto(out, data.transpose(2, 1, 0))
+			data = out
+		else:
+			# contiguous copy, a transposed view makes every later consumer pay for the strides
+			data = data.transpose(2, 1, 0).copy()
+		save_volume_cache(data, cache_path)
 	if (with_header):
 		return data, img.affine, img.header
 	else:
@@ -102,18 +151,28 @@ def convert_label(in_volume, label_convert_source, label_convert_target):
 	outputs:
 		out_volume: the output nd volume with label set label_convert_target
 	"""
-	mask_volume = np.zeros_like(in_volume)
-	convert_volume = np.zeros_like(in_volume)
-	for i in range(len(label_convert_source)):
-		source_lab = label_convert_source[i]
-		target_lab = label_convert_target[i]
-		if (source_lab != target_lab):
-			temp_source = np.asarray(in_volume == source_lab)
-			temp_target = target_lab * temp_source
-			mask_volume = mask_volume + temp_source
-			convert_volume = convert_volume + temp_target
-	out_volume = in_volume * 1
-	out_volume[mask_volume > 0] = convert_volume[mask_volume > 0]
+	source = np.asarray(label_convert_source)
+	target = np.asarray(label_convert_target)
+	if in_volume.size == 0:
+		return in_volume.copy()
+	if in_volume.dtype.kind in 'iu' and in_volume.dtype.itemsize <= 2:
+		# a single gather through a lookup table spanning the whole 8 / 16 bit range, so the volume is
+		# never scanned for its extent; indexing goes through the unsigned view so negative labels fit too
+		info = np.iinfo(in_volume.dtype)
+		index_dtype = np.dtype('u{}'.format(in_volume.dtype.itemsize))
+		lut = np.arange(info.max - info.min + 1, dtype=index_dtype).view(in_volume.dtype)
+		# labels outside the dtype range cannot occur in the volume
+		valid = (source >= info.min) & (source <= info.max)
+		lut[source[valid].astype(in_volume.dtype).view(index_dtype)] = target[valid]
+		return lut[in_volume.view(index_dtype)]
+	# wider integer or float labels: only look up the voxels whose label actually changes
+	changed = source != target
+	order = np.argsort(source[changed])
+	source = source[changed][order]
+	target = target[changed][order]
+	mask = np.isin(in_volume, source)
+	out_volume = in_volume.copy()
+	out_volume[mask] = target[np.searchsorted(source, in_volume[mask])]
 	return out_volume
 
 
@@ -189,6 +248,15 @@ def test_brats17(args):
 
 	lines = text_file.readlines()
 	log('The number of images is {}'.format(len(lines)))
+	# Setup Model, once for all the images
+	model = torch.load(model_path, map_location='cpu')
+	if torch.cuda.is_available():
+		model.cuda(0)
+	# print(model)
+	model.eval()
+
+	# nibabel releases the GIL while decompressing, so threads overlap the reads
+	loader = ThreadPoolExecutor(max_workers=5)
 	for i in range(0, len(lines)):
 		img_num = i
 		log('The current image number is {}'.format(img_num))
@@ -198,57 +266,63 @@ def test_brats17(args):
 		# print('the name after splitting is ', cur_im_name.split("|\")[0])
 		img_path = root_path + '/' + cur_im_name + '/' + os.path.basename(cur_im_name)
 
-		# T1 img
+		# The five volumes are independent gzip decodes, load them concurrently
 		t1_img_path = img_path + '_t1.nii.gz'
-		t1_img = load_nifty_volume_as_array(filename=t1_img_path, with_header=False)
+		t1ce_img_path = img_path + '_t1ce.nii.gz'
+		flair_img_path = img_path + '_flair.nii.gz'
+		t2_img_path = img_path + '_t2.nii.gz'
+		lbl_path = img_path + '_seg.nii.gz'
+		# Each modality is decoded straight into its channel of the network input, ordered t1, t2, t1ce, flair
+		input_shape = nibabel.load(t1_img_path).shape[::-1]
+		img = np.empty((4,) + tuple(input_shape), dtype=np.float32)
+		t1_future = loader.submit(load_nifty_volume_as_array, t1_img_path, out=img[0])
+		t2_future = loader.submit(load_nifty_volume_as_array, t2_img_path, out=img[1])
+		t1ce_future = loader.submit(load_nifty_volume_as_array, t1ce_img_path, out=img[2])
+		flair_future = loader.submit(load_nifty_volume_as_array, flair_img_path, out=img[3])
+		lbl_future = loader.submit(load_nifty_volume_as_array, lbl_path)
+
+		# T1 img
+		t1_img = t1_future.result()
 		log(t1_img_path)
 		log('The shape of t1 img is {}'.format(t1_img.shape))
 
 		# T1ce img
-		t1ce_img_path = img_path + '_t1ce.nii.gz'
-		t1ce_img = load_nifty_volume_as_array(filename=t1ce_img_path, with_header=False)
+		t1ce_img = t1ce_future.result()
 		log(t1ce_img_path)
 		log('The shape of t1ce img is {}'.format(t1ce_img.shape))
 
 		# Flair img
-		flair_img_path = img_path + '_flair.nii.gz'
-		flair_img = load_nifty_volume_as_array(filename=flair_img_path, with_header=False)
+		flair_img = flair_future.result()
 		log(flair_img_path)
 		log('The shape of flair img is {}'.format(flair_img.shape))
 
 		# T2 img
-		t2_img_path = img_path + '_t2.nii.gz'
-		t2_img = load_nifty_volume_as_array(filename=flair_img_path, with_header=False)
+		t2_img = t2_future.result()
 		log(t2_img_path)
-		log('The shape of t1ce img is {}'.format(t2_img.shape))
+		log('The shape of t2 img is {}'.format(t2_img.shape))
 
 		# segmentation label
-		lbl_path = img_path + '_seg.nii.gz'
-		lbl = load_nifty_volume_as_array(filename=lbl_path, with_header=False)
+		lbl = lbl_future.result()
 		log(lbl_path)
-		log('The shape of label map img is {}'.format(t2_img.shape))
+		log('The shape of label map img is {}'.format(lbl.shape))
 
-		# t1_img = normalize_try(t1_img, lbl)
-		# t1ce_img = normalize_try(t1ce_img, lbl)
-		# t2_img = normalize_try(t2_img, lbl)
-		# flair_img = normalize_try(flair_img, lbl)
+		# img[0] = normalize_try(t1_img, lbl)
+		# img[1] = normalize_try(t2_img, lbl)
+		# img[2] = normalize_try(t1ce_img, lbl)
+		# img[3] = normalize_try(flair_img, lbl)
 
-		img = np.stack((t1_img, t2_img, t1ce_img, flair_img))
 		input_im_sz = img.shape
 		log('The shape of img is {}'.format(img.shape))
 		img = np.expand_dims(img, axis=0)
 		log('The shape of img after dim expansion is {}'.format(img.shape))
 
-		# convert numpy type into torch type
-		img = torch.from_numpy(img).float()
+		# convert numpy type into torch type, img is float32 already so this shares its memory
+		img = torch.from_numpy(img)
+		if torch.cuda.is_available():
+			# a single copy of the whole volume, the patches are sliced on the GPU
+			img = img.cuda(0)
 		log('The shape pf img is {}'.format(img.size()))
 
-		# Setup Model
-		model = torch.load(model_path)
-		if torch.cuda.is_available():
-			model.cuda(0)
-		# print(model)
-		model.eval()
 		final_label = np.zeros([input_im_sz[1], input_im_sz[2], input_im_sz[3]], np.int16)
 		shapeX = input_im_sz[1]
 		shapeY = input_im_sz[2]
@@ -288,8 +362,6 @@ def test_brats17(args):
 
 					# log('overlapZ: {}'.format(overlapZ))
 					img_patch = img[:, :, x:x + patch_size[0], y:y + patch_size[1], z:z + patch_size[2]]
-					if torch.cuda.is_available():
-						img_patch = Variable(img_patch.cuda(0))
 					# print('patch tensor size: {}'.format(patch.size()))
 					pred = model(img_patch)
 
@@ -358,6 +430,7 @@ def test_brats17(args):
 		final_label = final_label * bi_t1_img
 		# print('The values of this prediction is {}'.format(np.unique(final_label)))
 		save_array_as_nifty_volume(final_label, 'runs/' + log_number + '/' + model_basename_no_ext + '/' + os.path.basename(cur_im_name) + ".nii.gz")
+	loader.shutdown()
 
 
 